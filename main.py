@@ -1,15 +1,68 @@
 import os
-import json
+import re
+import sys
+import logging
+import queue
+import atexit
 import time
 import requests
+import orjson
 import jwt
-import traceback
 import base64
 import secrets
+import threading
+import hashlib
+import html
+import math
+import itertools
 from typing import Optional
+from functools import lru_cache
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+class ORJSONProvider(JSONProvider):
+    """Serve jsonify() responses through orjson instead of the stdlib encoder."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+
+# Request threads only enqueue records; a listener thread does the stdout writes
+_log_queue = queue.SimpleQueue()
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+_log_listener = QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+# QueueHandler pre-renders the message (and any traceback) before enqueueing;
+# the timestamp/level prefix is added once, by the listener's formatter
+_log_enqueue = QueueHandler(_log_queue)
+_log_enqueue.setFormatter(logging.Formatter("%(message)s"))
+
+# WARNING in production skips per-request logs; an unknown name falls back to
+# INFO rather than stopping the worker from booting
+LOG_LEVEL = (os.environ.get("LOG_LEVEL") or "INFO").strip().upper()
+_log_level_valid = isinstance(logging.getLevelName(LOG_LEVEL), int)  # works before 3.11 too
+
+logging.basicConfig(
+    level=LOG_LEVEL if _log_level_valid else logging.INFO,
+    handlers=[_log_enqueue],
+)
+logger = logging.getLogger("bot")
+if not _log_level_valid:
+    logger.warning("Unknown LOG_LEVEL %r, using INFO", LOG_LEVEL)
 
 # This one works with Telegram notifications AND price alerts!
 
@@ -29,35 +82,178 @@ COINBASE_PRIVATE_KEY_B64 = os.environ.get("COINBASE_PRIVATE_KEY_B64")
 # ═════════════════════════════════════════
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")  # Your bot token from BotFather
 TELEGRAM_CHAT_ID = os.environ.get("TELEGRAM_CHAT_ID")      # Your chat ID
+# On unless explicitly switched off ("0", "false", "no", "off")
+SEND_STARTUP_PING = os.environ.get("SEND_STARTUP_PING", "1").strip().lower() not in ("0", "false", "no", "off")
 
 COINBASE_API_URL = "https://api.coinbase.com"
 
+# ─────────────────────────────────────────
+# HTTP sessions (keep-alive, one pool per upstream)
+# ─────────────────────────────────────────
+# No adapter-level retries: urllib3 would resend the original Authorization
+# header, whose cached JWT can expire during a long backoff. Coinbase retries
+# live in cb_request(), which signs every attempt.
+_CB_SESSION = requests.Session()
+_CB_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=0,
+))
+
+# sendMessage isn't idempotent, so only failures to connect (the request was
+# never sent) are retried; urllib3 doesn't retry POST on read errors or status
+_TG_SESSION = requests.Session()
+_TG_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=4,
+    max_retries=Retry(total=2, backoff_factor=0.2),
+))
+_TG_SESSION.headers["Content-Type"] = "application/json"
+TELEGRAM_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+
 # ─────────────────────────────────────────
 # TELEGRAM NOTIFICATION HELPER
 # ─────────────────────────────────────────
+TELEGRAM_TIMEOUT = 3  # seconds; notifications must never hold up trading
+
+TELEGRAM_DEDUP_WINDOW = 0.1  # seconds; an identical message inside this window is dropped
+
+TELEGRAM_BATCH_WINDOW = 0.5  # seconds; notifications queued within this window go out as one message
+TELEGRAM_MAX_LENGTH = 4000  # Telegram rejects sendMessage texts over 4096 chars
+_TELEGRAM_SEPARATOR = "\n\n───\n\n"
+
+TELEGRAM_FLUSH_TIMEOUT = 5  # seconds; how long shutdown waits for queued notifications
+
+TELEGRAM_RATE_LIMIT_RETRIES = 2  # resends of a batch after a 429
+TELEGRAM_MAX_RETRY_WAIT = 10     # seconds; cap on Telegram's retry_after
+
+# Bounded so a Telegram outage can't grow memory without limit; a single
+# sender thread keeps notifications in the order they were queued
+_TELEGRAM_QUEUE = queue.Queue(maxsize=256)
+
 def send_telegram_message(message: str):
     """
     Send a message to Telegram.
     This is where ALL notifications are sent from.
+    The HTTP call runs on a background thread so callers never wait on Telegram.
     """
     if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
-        print("WARNING: Telegram not configured. Skipping notification:", message)
+        logger.warning("Telegram not configured. Skipping notification: %s", message)
         return
-    
     try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+        # Stamp at enqueue time so the dedup window isn't skewed by a slow send
+        _TELEGRAM_QUEUE.put_nowait((message, time.monotonic()))
+    except queue.Full:
+        logger.error("❌ Telegram queue full, dropping notification: %s...", message[:50])
+
+def _telegram_sender():
+    last_message, last_seen = None, 0.0
+    while True:
+        # Block for the first message, then gather whatever else arrives
+        # within the batch window into as few sendMessage calls as possible
+        parts, taken = [], 0
+        deadline = None
+        while True:
+            try:
+                if deadline is None:
+                    message, queued_at = _TELEGRAM_QUEUE.get()
+                    deadline = time.monotonic() + TELEGRAM_BATCH_WINDOW
+                else:
+                    message, queued_at = _TELEGRAM_QUEUE.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            taken += 1
+            if message == last_message and queued_at - last_seen < TELEGRAM_DEDUP_WINDOW:
+                continue
+            last_message, last_seen = message, queued_at
+            if parts and len(_TELEGRAM_SEPARATOR.join(parts + [message])) > TELEGRAM_MAX_LENGTH:
+                _post_telegram_batch(parts)
+                parts = []
+            parts.append(message)
+        try:
+            if parts:
+                _post_telegram_batch(parts)
+        finally:
+            for _ in range(taken):
+                _TELEGRAM_QUEUE.task_done()
+
+def _post_telegram_batch(parts: list):
+    text = _TELEGRAM_SEPARATOR.join(parts)
+    resp = _post_telegram_message(text)
+    # 429: wait as long as Telegram asks and resend the same batch; splitting
+    # it would only spend more calls against the same rate limit
+    for _ in range(TELEGRAM_RATE_LIMIT_RETRIES):
+        if resp is None or resp.status_code != 429:
+            break
+        time.sleep(min(_telegram_retry_after(resp), TELEGRAM_MAX_RETRY_WAIT))
+        resp = _post_telegram_message(text)
+    # 400: Telegram rejected the combined text, so send each part on its own
+    # and let one bad message fail alone
+    if resp is not None and resp.status_code == 400 and len(parts) > 1:
+        for part in parts:
+            _post_telegram_message(part)
+
+def _telegram_retry_after(resp) -> float:
+    try:
+        return float(orjson.loads(resp.content)["parameters"]["retry_after"])
+    except Exception:
+        return 1.0
+
+def _post_telegram_message(message: str):
+    """Send one sendMessage request; return the response, or None if none arrived."""
+    try:
         payload = {
             "chat_id": TELEGRAM_CHAT_ID,
             "text": message,
             "parse_mode": "HTML"  # Allows bold, italic formatting
         }
-        resp = requests.post(url, json=payload, timeout=10)
+        resp = _TG_SESSION.post(TELEGRAM_URL, data=orjson.dumps(payload), timeout=TELEGRAM_TIMEOUT)
         if resp.status_code == 200:
-            print(f"✅ Telegram notification sent: {message[:50]}...")
+            logger.info("✅ Telegram notification sent: %s...", message[:50])
         else:
-            print(f"❌ Telegram API error: {resp.status_code} - {resp.text}")
+            logger.error("❌ Telegram API error: %s - %s", resp.status_code, resp.text)
+        return resp
     except Exception as e:
-        print(f"❌ Failed to send Telegram message: {repr(e)}")
+        logger.error("❌ Failed to send Telegram message: %r", e)
+        return None
+
+threading.Thread(target=_telegram_sender, name="telegram", daemon=True).start()
+
+def _flush_telegram_queue():
+    # The sender is a daemon thread, so without this a worker restart would
+    # silently drop whatever notifications were still queued
+    deadline = time.monotonic() + TELEGRAM_FLUSH_TIMEOUT
+    while _TELEGRAM_QUEUE.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+atexit.register(_flush_telegram_queue)
+
+# ─────────────────────────────────────────
+# Telegram message templates
+# ─────────────────────────────────────────
+MSG_STARTUP = "🚀 <b>Railway Trading Bot Started</b>\n\nBot is online and ready to receive signals and price alerts."
+MSG_CONFIG_ERROR = "⚠️ <b>Railway Configuration Error</b>\n\n{detail}"
+MSG_RAILWAY_ERROR = "⚠️ <b>Railway Error</b>\n\nAction: {action}\nSymbol: {product_id}\nError: {error}"
+
+MSG_BUY_OPENED = "✅ <b>BUY Order Opened</b>\n\nSymbol: {product_id}\nAmount: ${usd_amount}\nOrder ID: {order_id}\nStatus: Success"
+MSG_BUY_FAILED = "❌ <b>BUY Order FAILED</b>\n\nSymbol: {product_id}\nAmount: ${usd_amount}\nError: {error}"
+MSG_SELL_CLOSED = "✅ <b>SELL Order Closed</b>\n\nSymbol: {product_id}\nSize: {base_size} {base_currency}\nOrder ID: {order_id}\nStatus: Success"
+MSG_SELL_FAILED = "❌ <b>SELL Order FAILED</b>\n\nSymbol: {product_id}\nError: {error}"
+MSG_SELL_ORDER_FAILED = "❌ <b>SELL Order FAILED</b>\n\nSymbol: {product_id}\nSize: {base_size} {base_currency}\nError: {error}"
+
+MSG_ALERT = "📊 <b>Price Alert: {symbol}</b>\n\nCurrent Price: ${price}\nTime: {time}"
+MSG_ALERT_BY_DIRECTION = {
+    "ABOVE": "🚀 <b>Price Alert: {symbol}</b>\n\nCurrent Price: ${price}\nAlert: Price went ABOVE ${threshold}\nTime: {time}",
+    "BELOW": "⚠️ <b>Price Alert: {symbol}</b>\n\nCurrent Price: ${price}\nAlert: Price went BELOW ${threshold}\nTime: {time}",
+}
+
+def format_message(template: str, **fields) -> str:
+    """
+    Fill a MSG_* template, HTML-escaping every field: messages are sent with
+    parse_mode=HTML, so a stray '<' in an error or symbol would get the whole
+    sendMessage rejected.
+    """
+    return template.format(**{k: html.escape(str(v), quote=False) for k, v in fields.items()})
 
 # ─────────────────────────────────────────
 # PEM normalization helpers
@@ -82,30 +278,65 @@ if not COINBASE_PRIVATE_KEY and COINBASE_PRIVATE_KEY_B64:
     try:
         decoded = base64.b64decode(COINBASE_PRIVATE_KEY_B64)
         COINBASE_PRIVATE_KEY = normalize_pem(decoded)
-        print("INFO: Loaded COINBASE_PRIVATE_KEY from base64 env")
+        logger.info("Loaded COINBASE_PRIVATE_KEY from base64 env")
     except Exception as e:
-        print("ERROR: Failed to decode COINBASE_PRIVATE_KEY_B64:", repr(e))
+        logger.error("Failed to decode COINBASE_PRIVATE_KEY_B64: %r", e)
 
 if COINBASE_PRIVATE_KEY:
-    lines = COINBASE_PRIVATE_KEY.splitlines()
-    first_line = lines[0] if lines else ''
-    last_line = lines[-1] if lines else ''
-    print("INFO: PEM first line:", first_line)
-    print("INFO: PEM last line:", last_line)
+    pem_body = COINBASE_PRIVATE_KEY.strip()
+    first_line = pem_body.partition("\n")[0]
+    last_line = pem_body.rpartition("\n")[2]
+    logger.debug("PEM first line: %s", first_line)
+    logger.debug("PEM last line: %s", last_line)
 
 # ─────────────────────────────────────────
-# Require env vars per request
+# Parsed private key (loaded once, on first use)
 # ─────────────────────────────────────────
-def require_env():
+_private_key = None
+_private_key_lock = threading.Lock()
+
+def get_private_key():
+    """
+    Parse COINBASE_PRIVATE_KEY into an EC key object the first time it is needed.
+    Handing the object to jwt.encode skips re-parsing the PEM on every signature.
+    """
+    global _private_key
+    if _private_key is None:
+        with _private_key_lock:
+            if _private_key is None:
+                _private_key = load_pem_private_key(COINBASE_PRIVATE_KEY.encode(), password=None)
+    return _private_key
+
+# ─────────────────────────────────────────
+# Env validation (evaluated once at boot, enforced per request)
+# ─────────────────────────────────────────
+def check_env():
+    """
+    Return (error, telegram_detail) describing the configuration problem, or (None, None).
+    Also parses the private key so the first signal doesn't pay for it.
+    """
     missing = []
     if not COINBASE_API_KEY_NAME:
         missing.append("COINBASE_API_KEY_NAME")
     if not COINBASE_PRIVATE_KEY:
         missing.append("COINBASE_PRIVATE_KEY")
     if missing:
-        error_msg = f"⚠️ <b>Railway Configuration Error</b>\n\nMissing: {', '.join(missing)}"
-        send_telegram_message(error_msg)
-        raise RuntimeError(f"Missing environment variables: {', '.join(missing)}")
+        return f"Missing environment variables: {', '.join(missing)}", f"Missing: {', '.join(missing)}"
+    try:
+        get_private_key()
+    except Exception as e:
+        return f"Invalid COINBASE_PRIVATE_KEY: {e!r}", f"Invalid COINBASE_PRIVATE_KEY: {e!r}"
+    return None, None
+
+# Env vars can't change while the process runs, so check them once
+_ENV_ERROR, _ENV_ERROR_DETAIL = check_env()
+if _ENV_ERROR:
+    logger.error("%s", _ENV_ERROR)
+
+def require_env():
+    if _ENV_ERROR:
+        send_telegram_message(format_message(MSG_CONFIG_ERROR, detail=_ENV_ERROR_DETAIL))
+        raise RuntimeError(_ENV_ERROR)
 
 # ─────────────────────────────────────────
 # JWT creation for Coinbase Advanced Trade REST (ES256)
@@ -115,77 +346,234 @@ DEF_HOST = "api.coinbase.com"
 def build_uri(method: str, path: str, host: str = DEF_HOST) -> str:
     return f"{method.upper()} {host}{path}"
 
-def create_jwt(method: str, path: str) -> str:
+JWT_TTL = 120            # seconds a token stays valid (exp - nbf)
+# Re-sign when fewer than this many seconds remain; must outlast one Coinbase
+# attempt (CB_TIMEOUT applies to connect and read separately)
+JWT_REFRESH_MARGIN = 30
+
+# Claims/headers that never change for the lifetime of the process
+_JWT_STATIC_PAYLOAD = {"iss": "cdp", "sub": COINBASE_API_KEY_NAME}
+_JWT_STATIC_HEADERS = {"kid": COINBASE_API_KEY_NAME}
+
+# Nonces only need to be unique per token: a random per-process prefix plus a
+# counter gives that without reading the OS entropy pool on every signature
+_JWT_NONCE_PREFIX = secrets.token_hex(8)
+_JWT_NONCE_COUNTER = itertools.count()
+
+# Tokens are bound to a single "METHOD host/path" uri, so cache per (method, path)
+_jwt_cache = {}
+_jwt_lock = threading.Lock()
+
+def _signed_entry(method: str, path: str) -> tuple:
+    """
+    Return the cached (token, exp, auth headers) for this request, signing a new
+    ES256 JWT only when the cached one is within JWT_REFRESH_MARGIN of expiry.
+    """
+    key = (method.upper(), path)
     now = int(time.time())
+    with _jwt_lock:
+        cached = _jwt_cache.get(key)
+        if cached and cached[1] - now > JWT_REFRESH_MARGIN:
+            return cached
+
     payload = {
-        "iss": "cdp",
-        "sub": COINBASE_API_KEY_NAME,
+        **_JWT_STATIC_PAYLOAD,
         "nbf": now,
-        "exp": now + 120,
-        "uri": build_uri(method, path, DEF_HOST),
-    }
-    headers = {
-        "kid": COINBASE_API_KEY_NAME,
-        "nonce": secrets.token_hex(),
+        "exp": now + JWT_TTL,
+        "uri": _JWT_URIS.get(key) or build_uri(method, path, DEF_HOST),
     }
+    headers = {**_JWT_STATIC_HEADERS, "nonce": f"{_JWT_NONCE_PREFIX}{next(_JWT_NONCE_COUNTER):016x}"}
     try:
-        return jwt.encode(payload, COINBASE_PRIVATE_KEY, algorithm="ES256", headers=headers)
+        token = jwt.encode(payload, get_private_key(), algorithm="ES256", headers=headers)
     except Exception as e:
-        print("ERROR: JWT encode failed:", repr(e))
-        print("TRACEBACK:", traceback.format_exc())
+        logger.exception("JWT encode failed: %r", e)
         raise
 
-def auth_headers(method: str, path: str) -> dict:
-    token = create_jwt(method, path)
-    return {
+    # requests copies headers per call, so one dict can be shared read-only
+    entry = (token, now + JWT_TTL, {
         "Authorization": f"Bearer {token}",
         "Content-Type": "application/json",
-    }
+    })
+    with _jwt_lock:
+        _jwt_cache[key] = entry
+    return entry
+
+def create_jwt(method: str, path: str) -> str:
+    """
+    Return a signed ES256 JWT for the given request.
+    Tokens are reused until they are within JWT_REFRESH_MARGIN of expiry,
+    so bursts of webhooks don't pay for an ECDSA signature each time.
+    """
+    return _signed_entry(method, path)[0]
+
+def auth_headers(method: str, path: str) -> dict:
+    return _signed_entry(method, path)[2]
 
 # ─────────────────────────────────────────
 # REST helpers
 # ─────────────────────────────────────────
 ACCOUNTS_PATH = "/api/v3/brokerage/accounts"
 ORDERS_PATH = "/api/v3/brokerage/orders"
+ACCOUNTS_URL = f"{COINBASE_API_URL}{ACCOUNTS_PATH}"
+ORDERS_URL = f"{COINBASE_API_URL}{ORDERS_PATH}"
 
-def fetch_accounts():
-    headers = auth_headers("GET", ACCOUNTS_PATH)
-    resp = requests.get(f"{COINBASE_API_URL}{ACCOUNTS_PATH}", headers=headers, timeout=10)
-    print("Coinbase response (accounts):", resp.status_code, resp.text)
+# JWT "uri" claims for the endpoints this bot calls, keyed like _jwt_cache
+_JWT_URIS = {
+    ("GET", ACCOUNTS_PATH): build_uri("GET", ACCOUNTS_PATH),
+    ("POST", ORDERS_PATH): build_uri("POST", ORDERS_PATH),
+}
+
+def read_response(resp, label: str):
+    """
+    Log a Coinbase response and return (status, parsed body).
+    The body is parsed straight from bytes, in a single pass.
+    """
+    body = resp.content
+    logger.info("Coinbase response (%s): %s", label, resp.status_code)
+    logger.debug("Coinbase response body (%s): %r", label, body[:512])
     try:
-        return resp.status_code, resp.json()
-    except Exception:
-        return resp.status_code, {"raw": resp.text}
+        return resp.status_code, orjson.loads(body) if body else {}
+    except orjson.JSONDecodeError:
+        return resp.status_code, {"raw": body.decode("utf-8", errors="replace")}
 
-def place_market_order(product_id: str, side: str, usd_amount: Optional[float] = None, base_size: Optional[str] = None):
-    headers = auth_headers("POST", ORDERS_PATH)
-    order = {
-        "client_order_id": str(int(time.time() * 1000)),
-        "product_id": product_id,
-        "side": side.upper(),
-        "order_configuration": {
-            "market_market_ioc": {}
-        },
-    }
-    if side.lower() == "buy":
-        if not usd_amount:
-            raise ValueError("BUY requires usd_amount")
-        order["order_configuration"]["market_market_ioc"]["quote_size"] = str(usd_amount)
-    else:
-        if not base_size:
-            raise ValueError("SELL requires base_size")
-        order["order_configuration"]["market_market_ioc"]["base_size"] = str(base_size)
-
-    resp = requests.post(f"{COINBASE_API_URL}{ORDERS_PATH}", headers=headers, json=order, timeout=10)
-    print("Coinbase response (order):", resp.status_code, resp.text)
+ACCOUNTS_PAGE_SIZE = 250  # API maximum; the default page (49) can miss a currency
+
+CB_TIMEOUT = 10                  # seconds per attempt
+CB_MAX_ATTEMPTS = 4
+CB_RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+CB_BACKOFF = 0.3                 # seconds, doubled after each failed attempt
+CB_MAX_RETRY_WAIT = 5            # cap on any single wait, including Retry-After
+
+def _retry_after(resp) -> Optional[float]:
     try:
-        return resp.status_code, resp.json()
-    except Exception:
-        return resp.status_code, {"raw": resp.text}
+        return float(resp.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+def cb_request(method: str, path: str, url: str, **kwargs):
+    """
+    Send a Coinbase request, retrying connection errors, timeouts and
+    CB_RETRY_STATUSES. Auth headers are fetched again for every attempt, so a
+    retry never goes out with a JWT that expired while we were waiting.
+    Orders are safe to resend because Coinbase de-duplicates on client_order_id.
+    """
+    for attempt in range(1, CB_MAX_ATTEMPTS + 1):
+        delay = CB_BACKOFF * 2 ** (attempt - 1)
+        try:
+            resp = _CB_SESSION.request(method, url, headers=auth_headers(method, path),
+                                       timeout=CB_TIMEOUT, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == CB_MAX_ATTEMPTS:
+                raise
+            logger.warning("Coinbase %s %s failed (%r), retry %d", method, path, e, attempt)
+        else:
+            if resp.status_code not in CB_RETRY_STATUSES or attempt == CB_MAX_ATTEMPTS:
+                return resp
+            delay = _retry_after(resp) or delay
+            logger.warning("Coinbase %s %s returned %s, retry %d", method, path, resp.status_code, attempt)
+        time.sleep(min(delay, CB_MAX_RETRY_WAIT))
+
+def fetch_accounts():
+    # Query params are not part of the signed JWT uri, only the path is
+    resp = cb_request("GET", ACCOUNTS_PATH, ACCOUNTS_URL, params={"limit": ACCOUNTS_PAGE_SIZE})
+    return read_response(resp, "accounts")
+
+BALANCE_CACHE_TTL = 2.0  # seconds an accounts listing is reused between SELLs
+
+# "gen" is bumped on every invalidation so a fetch that started before an order
+# can't store its (now stale) listing afterwards
+_balance_cache = {"balances": None, "ts": 0.0, "gen": 0}
+_balance_cache_lock = threading.Lock()
+
+def invalidate_balance_cache():
+    with _balance_cache_lock:
+        _balance_cache["balances"] = None
+        _balance_cache["gen"] += 1
+
+def index_balances(accounts: list) -> dict:
+    """
+    Map currency -> available balance (as a string) for accounts holding a
+    positive amount, keeping the first such account per currency.
+    """
+    balances = {}
+    for acct in accounts:
+        currency = acct.get("currency")
+        if currency in balances:
+            continue
+        val = (acct.get("available_balance") or {}).get("value")
+        if val and float(val) > 0:
+            balances[currency] = str(val)
+    return balances
+
+def get_available_balance(currency: str):
+    """
+    Return (status, balance) where balance is the available amount of `currency`
+    as a string, or None if there is nothing to sell.
+    The indexed accounts listing is reused for BALANCE_CACHE_TTL seconds and dropped
+    whenever an order is placed, so back-to-back SELLs skip the extra round-trip.
+    """
+    with _balance_cache_lock:
+        balances = _balance_cache["balances"]
+        if balances is not None and time.time() - _balance_cache["ts"] >= BALANCE_CACHE_TTL:
+            balances = None
+        gen = _balance_cache["gen"]
+
+    if balances is None:
+        status, data = fetch_accounts()
+        if status >= 300:
+            return status, None
+        balances = index_balances(data.get("accounts", []))
+        with _balance_cache_lock:
+            if _balance_cache["gen"] == gen:
+                _balance_cache["balances"] = balances
+                _balance_cache["ts"] = time.time()
+
+    return 200, balances.get(currency)
+
+def _post_order(order: dict):
+    resp = cb_request("POST", ORDERS_PATH, ORDERS_URL, data=orjson.dumps(order))
+    if resp.status_code < 300:
+        invalidate_balance_cache()
+    return read_response(resp, "order")
+
+# Random per-process prefix + counter: unique across restarts and never
+# collides for orders placed in the same millisecond
+_ORDER_ID_PREFIX = secrets.token_hex(4)
+_ORDER_ID_COUNTER = itertools.count(1)
+
+def new_client_order_id() -> str:
+    return f"{_ORDER_ID_PREFIX}-{next(_ORDER_ID_COUNTER)}"
+
+def place_buy(product_id: str, usd_amount: float, client_order_id: str):
+    """Market BUY spending `usd_amount` of the quote currency."""
+    if not usd_amount:
+        raise ValueError("BUY requires usd_amount")
+    return _post_order({
+        "client_order_id": client_order_id,
+        "product_id": product_id,
+        "side": "BUY",
+        "order_configuration": {"market_market_ioc": {"quote_size": str(usd_amount)}},
+    })
+
+def place_sell(product_id: str, base_size: str, client_order_id: str):
+    """Market SELL of `base_size` units of the base currency."""
+    if not base_size:
+        raise ValueError("SELL requires base_size")
+    return _post_order({
+        "client_order_id": client_order_id,
+        "product_id": product_id,
+        "side": "SELL",
+        "order_configuration": {"market_market_ioc": {"base_size": str(base_size)}},
+    })
 
 # ─────────────────────────────────────────
 # Helper: Normalize symbol format
 # ─────────────────────────────────────────
+# Same split as checking the USDC / USDT / USD suffixes in turn, in one match
+_SYMBOL_RE = re.compile(r"^([A-Z0-9]+?)(USDC|USDT|USD)$")
+
+# TradingView alerts reuse a handful of tickers, so remember the mapping
+@lru_cache(maxsize=256)
 def normalize_symbol(symbol: str) -> str:
     """
     Normalize symbol to Coinbase format (e.g., BTC-USDC, ETH-USDC, SOL-USDC)
@@ -199,10 +587,9 @@ def normalize_symbol(symbol: str) -> str:
     
     # Common patterns: BTCUSDC, ETHUSDC, SOLUSDC, etc.
     # Split by USDC, USDT, USD
-    for quote in ["USDC", "USDT", "USD"]:
-        if symbol.endswith(quote):
-            base = symbol[:-len(quote)]
-            return f"{base}-{quote}"
+    match = _SYMBOL_RE.match(symbol)
+    if match:
+        return f"{match.group(1)}-{match.group(2)}"
     
     # If no known quote currency, return as-is
     return symbol
@@ -216,89 +603,164 @@ def get_base_currency(product_id: str) -> str:
     """
     return product_id.split("-")[0]
 
+# ─────────────────────────────────────────
+# Duplicate signal suppression
+# ─────────────────────────────────────────
+DUPLICATE_WINDOW = 10  # seconds an identical webhook body is treated as a retry
+
+_recent_signals = {}
+_recent_signals_lock = threading.Lock()
+
+def is_duplicate_signal(body: bytes) -> bool:
+    """
+    Return True if the same webhook body was already accepted within DUPLICATE_WINDOW.
+    Otherwise remember it and return False.
+    """
+    key = hashlib.sha256(body).hexdigest()
+    now = time.time()
+    with _recent_signals_lock:
+        for k, ts in list(_recent_signals.items()):
+            if now - ts >= DUPLICATE_WINDOW:
+                del _recent_signals[k]
+        if key in _recent_signals:
+            return True
+        _recent_signals[key] = now
+    return False
+
+# ─────────────────────────────────────────
+# Trade execution (runs on the background executor)
+# ─────────────────────────────────────────
+# One worker: trades run strictly in the order their webhooks arrived, so a
+# SELL can never overtake (and sell into) a BUY that was sent before it
+_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trade")
+_EXECUTOR_SUBMIT_LOCK = threading.Lock()  # keeps client_order_id order == execution order
+
+def execute_trade(action: str, product_id: str, base_currency: str, client_order_id: str,
+                  usd_amount: Optional[float] = None, base_size: Optional[str] = None):
+    """
+    Place the order for an already-validated signal.
+    Results and failures are reported via Telegram since the webhook has already returned.
+    """
+    try:
+        if action == "buy":
+            # Execute BUY order
+            status, resp = place_buy(product_id, usd_amount, client_order_id)
+            
+            if status >= 300:
+                error_details = resp.get("error_response", {}).get("message", "Unknown error")
+                send_telegram_message(format_message(MSG_BUY_FAILED,
+                    product_id=product_id, usd_amount=usd_amount, error=error_details))
+                return
+            
+            order_id = resp.get("success_response", {}).get("order_id", "N/A")
+            send_telegram_message(format_message(MSG_BUY_OPENED,
+                product_id=product_id, usd_amount=usd_amount, order_id=order_id))
+            
+        else:  # SELL
+            # Without an explicit size, sell the full available balance of the base currency
+            if base_size is None:
+                status_accounts, base_size = get_available_balance(base_currency)
+                if status_accounts >= 300:
+                    send_telegram_message(format_message(MSG_SELL_FAILED,
+                        product_id=product_id, error="Failed to fetch account balance"))
+                    return
+            
+            if not base_size:
+                send_telegram_message(format_message(MSG_SELL_FAILED,
+                    product_id=product_id, error=f"No {base_currency} available to sell"))
+                return
+            
+            # Execute SELL order
+            status, resp = place_sell(product_id, base_size, client_order_id)
+            
+            if status >= 300:
+                error_details = resp.get("error_response", {}).get("message", "Unknown error")
+                send_telegram_message(format_message(MSG_SELL_ORDER_FAILED,
+                    product_id=product_id, base_size=base_size, base_currency=base_currency, error=error_details))
+                return
+            
+            order_id = resp.get("success_response", {}).get("order_id", "N/A")
+            send_telegram_message(format_message(MSG_SELL_CLOSED,
+                product_id=product_id, base_size=base_size, base_currency=base_currency, order_id=order_id))
+
+    except Exception as e:
+        logger.exception("Trade execution failed: %r", e)
+        
+        send_telegram_message(format_message(MSG_RAILWAY_ERROR,
+            action=action.upper(), product_id=product_id, error=str(e)[:200]))
+
 # ─────────────────────────────────────────
 # Webhook endpoint
 # ─────────────────────────────────────────
+_VALID_ACTIONS = frozenset(("buy", "sell"))
+
+# Plain-text alerts: "BUY", "SELL BTCUSDC", "sell alert for btc-usdc", ...
+# Only a pair-shaped word (a letter first, ending in a quote currency) is taken
+# as the symbol, so prices like "65000USD" are skipped;
+# anything else leaves it unset so the missing-symbol 400 still applies
+_TEXT_SIGNAL_RE = re.compile(
+    rb"\s*(BUY|SELL)\b(?:.*?\b([A-Z][A-Z0-9]*-?(?:USDC|USDT|USD))\b)?",
+    re.IGNORECASE | re.DOTALL,
+)
+
 @app.route("/webhook", methods=["POST"])
 def webhook():
-    raw_body = request.data.decode("utf-8", errors="ignore")
-    print("=" * 80)
-    print("RAW WEBHOOK BODY:", raw_body)
-    print("=" * 80)
+    body = request.get_data(cache=False)
+    logger.debug("RAW WEBHOOK BODY: %r", body)
 
     # Parse JSON or fallback plain text
     data = None
     try:
-        data = json.loads(raw_body)
-        print("PARSED JSON DATA:", json.dumps(data, indent=2))
+        data = orjson.loads(body)
+        logger.debug("PARSED JSON DATA: %s", data)
     except Exception as parse_error:
-        print("JSON PARSE ERROR:", repr(parse_error))
-        text = raw_body.strip()
-        upper = text.upper()
-        if upper.startswith("BUY"):
-            data = {"action": "buy"}
-        elif upper.startswith("SELL"):
-            data = {"action": "sell"}
-        else:
-            print(f"ERROR: Could not parse body. Not JSON and doesn't start with BUY/SELL")
-            return jsonify(error="Body is not valid JSON and no BUY/SELL keyword found", received=raw_body[:200]), 400
-
-    action = (data.get("action") or "").strip().lower()
-    print(f"ACTION EXTRACTED: '{action}'")
+        logger.info("JSON PARSE ERROR: %r", parse_error)
+        match = _TEXT_SIGNAL_RE.match(body)
+        if not match:
+            logger.error("Could not parse body. Not JSON and doesn't start with BUY/SELL")
+            raw_body = body[:200].decode("utf-8", errors="ignore")
+            return jsonify(error="Body is not valid JSON and no BUY/SELL keyword found", received=raw_body), 400
+        data = {"action": match.group(1).decode().lower()}
+        if match.group(2):
+            data["symbol"] = match.group(2).decode()
+
+    if not isinstance(data, dict):
+        return jsonify(error="JSON body must be an object", received=body[:200].decode("utf-8", errors="ignore")), 400
+
+    action = data.get("action")
+    action = action.strip().lower() if isinstance(action, str) else ""
+    logger.info("ACTION EXTRACTED: '%s'", action)
     
     # ═════════════════════════════════════════
     # NEW: HANDLE PRICE ALERTS (NO TRADING)
     # ═════════════════════════════════════════
     if action == "alert":
-        print("Processing ALERT action...")
-        symbol = data.get("symbol", "Unknown").strip()
+        logger.info("Processing ALERT action...")
+        symbol = data.get("symbol")
+        symbol = symbol.strip() if isinstance(symbol, str) else "Unknown"
         price = data.get("price", "N/A")
-        direction = data.get("direction", "").strip().upper()  # "ABOVE" or "BELOW"
+        direction = data.get("direction")
+        direction = direction.strip().upper() if isinstance(direction, str) else ""  # "ABOVE" or "BELOW"
         threshold = data.get("threshold", "N/A")
         
-        print(f"Alert details: symbol={symbol}, price={price}, direction={direction}, threshold={threshold}")
+        logger.info("Alert details: symbol=%s, price=%s, direction=%s, threshold=%s", symbol, price, direction, threshold)
+        alert_time = time.strftime('%Y-%m-%d %H:%M:%S')
         
         # Send Telegram notification
-        if direction == "ABOVE":
-            emoji = "🚀"
-            message = (
-                f"{emoji} <b>Price Alert: {symbol}</b>\n\n"
-                f"Current Price: ${price}\n"
-                f"Alert: Price went ABOVE ${threshold}\n"
-                f"Time: {time.strftime('%Y-%m-%d %H:%M:%S')}"
-            )
-        elif direction == "BELOW":
-            emoji = "⚠️"
-            message = (
-                f"{emoji} <b>Price Alert: {symbol}</b>\n\n"
-                f"Current Price: ${price}\n"
-                f"Alert: Price went BELOW ${threshold}\n"
-                f"Time: {time.strftime('%Y-%m-%d %H:%M:%S')}"
-            )
-        else:
-            message = (
-                f"📊 <b>Price Alert: {symbol}</b>\n\n"
-                f"Current Price: ${price}\n"
-                f"Time: {time.strftime('%Y-%m-%d %H:%M:%S')}"
-            )
-        
-        send_telegram_message(message)
+        template = MSG_ALERT_BY_DIRECTION.get(direction, MSG_ALERT)
+        send_telegram_message(format_message(template,
+            symbol=symbol, price=price, threshold=threshold, time=alert_time))
         return jsonify(status="alert sent", symbol=symbol, price=price), 200
 
     # ═════════════════════════════════════════
     # EXISTING: HANDLE BUY/SELL TRADING
     # ═════════════════════════════════════════
-    try:
-        require_env()
-    except RuntimeError as e:
-        print("ERROR: Env validation failed:", str(e))
-        return jsonify(error=str(e)), 500
-
-    symbol = data.get("symbol", "").strip()
+    symbol = data.get("symbol")
+    symbol = symbol.strip() if isinstance(symbol, str) else ""
     usd_amount = data.get("usd_amount")
     
     # Validate action
-    if action not in {"buy", "sell"}:
+    if action not in _VALID_ACTIONS:
         return jsonify(
             error="Invalid or missing 'action'",
             hint="Webhook must include {'action':'buy'|'sell'|'alert', 'symbol':'BTC-USDC', ...}"
@@ -323,110 +785,51 @@ def webhook():
                 hint="Include 'usd_amount' field with dollar amount to spend"
             ), 400
         try:
+            if isinstance(usd_amount, bool):
+                raise TypeError("usd_amount must be a number")
             usd_amount = float(usd_amount)
+            if not math.isfinite(usd_amount):
+                raise ValueError("usd_amount must be finite")
             if usd_amount <= 0:
                 return jsonify(error="usd_amount must be greater than 0"), 400
         except (ValueError, TypeError):
             return jsonify(error=f"Invalid usd_amount: {usd_amount}"), 400
 
+    # Optional explicit size for SELL orders; skips the balance lookup
+    base_size = data.get("base_size") if action == "sell" else None
+    if base_size is not None:
+        try:
+            # bool is an int subclass; JSON true must not become "True"
+            if isinstance(base_size, bool) or not isinstance(base_size, (str, int, float)):
+                raise TypeError("base_size must be a number or numeric string")
+            size = Decimal(str(base_size).strip())
+            if not math.isfinite(size):
+                raise ValueError("base_size must be finite")
+        except (ArithmeticError, ValueError, TypeError):
+            return jsonify(error=f"Invalid base_size: {base_size}"), 400
+        if size <= 0:
+            return jsonify(error="base_size must be greater than 0"), 400
+        # Plain decimal notation: str(1e-05) would send "1e-05"
+        base_size = format(size, "f")
+
+    # Only well-formed trade signals get as far as checking credentials
     try:
-        if action == "buy":
-            # Execute BUY order
-            status, resp = place_market_order(product_id, "buy", usd_amount=usd_amount)
-            
-            if status >= 300:
-                error_details = resp.get("error_response", {}).get("message", "Unknown error")
-                message = (
-                    f"❌ <b>BUY Order FAILED</b>\n\n"
-                    f"Symbol: {product_id}\n"
-                    f"Amount: ${usd_amount}\n"
-                    f"Error: {error_details}"
-                )
-                send_telegram_message(message)
-                return jsonify(error="Coinbase order failed", details=resp), 400
-            
-            order_id = resp.get("success_response", {}).get("order_id", "N/A")
-            message = (
-                f"✅ <b>BUY Order Opened</b>\n\n"
-                f"Symbol: {product_id}\n"
-                f"Amount: ${usd_amount}\n"
-                f"Order ID: {order_id}\n"
-                f"Status: Success"
-            )
-            send_telegram_message(message)
-            
-            return jsonify(status="order placed", action=action, product_id=product_id, details=resp), 200
-            
-        else:  # SELL
-            # Fetch account balance for the base currency
-            status_accounts, data_accounts = fetch_accounts()
-            if status_accounts >= 300:
-                message = (
-                    f"❌ <b>SELL Order FAILED</b>\n\n"
-                    f"Symbol: {product_id}\n"
-                    f"Error: Failed to fetch account balance"
-                )
-                send_telegram_message(message)
-                return jsonify(error="Failed to fetch accounts", details=data_accounts), 400
-
-            # Find the base currency balance (e.g., BTC, ETH, SOL)
-            base_size = None
-            for acct in data_accounts.get("accounts", []):
-                if acct.get("currency") == base_currency:
-                    ab = acct.get("available_balance") or {}
-                    val = ab.get("value")
-                    if val and float(val) > 0:
-                        base_size = str(val)
-                        break
-            
-            if not base_size:
-                message = (
-                    f"❌ <b>SELL Order FAILED</b>\n\n"
-                    f"Symbol: {product_id}\n"
-                    f"Error: No {base_currency} available to sell"
-                )
-                send_telegram_message(message)
-                return jsonify(error=f"No {base_currency} available to sell"), 400
-            
-            # Execute SELL order
-            status, resp = place_market_order(product_id, "sell", base_size=base_size)
-            
-            if status >= 300:
-                error_details = resp.get("error_response", {}).get("message", "Unknown error")
-                message = (
-                    f"❌ <b>SELL Order FAILED</b>\n\n"
-                    f"Symbol: {product_id}\n"
-                    f"Size: {base_size} {base_currency}\n"
-                    f"Error: {error_details}"
-                )
-                send_telegram_message(message)
-                return jsonify(error="Coinbase order failed", details=resp), 400
-            
-            order_id = resp.get("success_response", {}).get("order_id", "N/A")
-            message = (
-                f"✅ <b>SELL Order Closed</b>\n\n"
-                f"Symbol: {product_id}\n"
-                f"Size: {base_size} {base_currency}\n"
-                f"Order ID: {order_id}\n"
-                f"Status: Success"
-            )
-            send_telegram_message(message)
-            
-            return jsonify(status="order placed", action=action, product_id=product_id, details=resp), 200
+        require_env()
+    except RuntimeError as e:
+        logger.error("Env validation failed: %s", e)
+        return jsonify(error=str(e)), 500
 
-    except Exception as e:
-        print("ERROR:", repr(e))
-        print("TRACEBACK:", traceback.format_exc())
-        
-        message = (
-            f"⚠️ <b>Railway Error</b>\n\n"
-            f"Action: {action.upper()}\n"
-            f"Symbol: {product_id if 'product_id' in locals() else 'Unknown'}\n"
-            f"Error: {str(e)[:200]}"
-        )
-        send_telegram_message(message)
-        
-        return jsonify(error="Unhandled exception", details=str(e)), 500
+    # Drop repeated deliveries of the same signal (e.g. TradingView retries)
+    if is_duplicate_signal(body):
+        logger.info("Duplicate webhook ignored")
+        return jsonify(status="duplicate ignored", action=action, product_id=product_id), 200
+
+    # Execute in the background so TradingView gets an immediate ack;
+    # the outcome is reported via Telegram
+    with _EXECUTOR_SUBMIT_LOCK:
+        client_order_id = new_client_order_id()
+        _EXECUTOR.submit(execute_trade, action, product_id, base_currency, client_order_id, usd_amount, base_size)
+    return jsonify(status="queued", action=action, product_id=product_id, client_order_id=client_order_id), 202
 
 # ─────────────────────────────────────────
 # Health check endpoint
@@ -435,9 +838,10 @@ def webhook():
 def health():
     return "OK", 200
 
-# Send startup notification
-if TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID:
-    send_telegram_message("🚀 <b>Railway Trading Bot Started</b>\n\nBot is online and ready to receive signals and price alerts.")
+# Send startup notification (queued, so it never delays boot)
+if SEND_STARTUP_PING and TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID:
+    send_telegram_message(MSG_STARTUP)
 
+# Local development only; production runs under gunicorn (see Procfile)
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))